@@ -1,17 +1,44 @@
-from os import makedirs
-from os.path import exists, join
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from os import fstat, makedirs, replace, unlink
+from os.path import dirname, exists, join, split
 from pathlib import Path
-from shutil import rmtree
-from typing import Optional, Union
+from queue import SimpleQueue
+from secrets import token_hex
+from shutil import copyfile, rmtree
+from threading import local
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from urllib.parse import quote
 
-from github import Github, GithubException
+from github import Github, UnknownObjectException
 from github.ContentFile import ContentFile
 from github.Repository import Repository
+from requests import Session
+from requests.adapters import HTTPAdapter
 from rich import print
 from typer import Option, Typer
-from wget import download as wget_download
+
+try:
+    from os import copy_file_range
+except ImportError:  # Python < 3.8 or platforms without copy_file_range
+    copy_file_range = None
 
 app = Typer()
+listing_worker = local()
+
+GITHUB_URL_PREFIX = "https://github.com/"
+GITHUB_URL_PREFIX_LENGTH = len(GITHUB_URL_PREFIX)
+LISTING_WORKERS = 8
+DOWNLOAD_WORKERS = 16
+DOWNLOAD_QUEUE_SIZE = 4 * DOWNLOAD_WORKERS
+DOWNLOAD_POOL_SIZE = 32
+CHUNK_SIZE = 1024 * 1024
+
+
+class RemoteFile(NamedTuple):
+    path: str
+    download_url: str
+    size: int
+    sha: str
 
 
 @app.command()
@@ -32,19 +59,20 @@ def download_command(
     if not branch:
         branch = repository.default_branch
     sha = get_sha_for_branch_or_tag(repository, branch)
-    download_folder(repository, sha, path, output, force)
+    session = create_session(token)
+    download_folder(repository, sha, path, output, force, session, token)
 
 
 def parse_github_url(url: str) -> tuple[str, str, Union[str, None], str]:
     """
     Parses a GitHub repo url and returns the owner, repo, branch and path.
     """
-    if not url.startswith("https://github.com/"):
+    if not url.startswith(GITHUB_URL_PREFIX):
         raise ValueError("Invalid GitHub URL")
-    url = url.replace("https://github.com/", "")
+    url = url[GITHUB_URL_PREFIX_LENGTH:]
     if url.endswith(".git"):
         url = url[:-4]
-    segments = url.split("/")
+    segments = url.split("/", 4)
     segments_count = len(segments)
     if segments_count < 2 or segments_count == 3:
         raise ValueError("Invalid GitHub URL")
@@ -55,7 +83,7 @@ def parse_github_url(url: str) -> tuple[str, str, Union[str, None], str]:
         path = ""
     else:
         branch = segments[3]
-        path = "/".join(segments[4:])
+        path = segments[4] if segments_count == 5 else ""
     return org, repo, branch, path
 
 
@@ -63,15 +91,204 @@ def get_sha_for_branch_or_tag(repository: Repository, branch_or_tag: str) -> str
     """
     Returns a commit PyGithub object for the specified repository and branch or tag.
     """
+    for ref_type in ("heads", "tags"):
+        ref_name = f"{ref_type}/{branch_or_tag}"
+        try:
+            ref = repository.get_git_ref(ref_name)
+        except UnknownObjectException:
+            continue
+        # The refs endpoint returns every ref starting with the name when there
+        # is no exact match, so only trust a ref with exactly that name.
+        if ref.ref != f"refs/{ref_name}":
+            continue
+        target = ref.object
+        while target.type == "tag":
+            target = repository.get_git_tag(target.sha).object
+        if target.type == "commit":
+            return target.sha
     branches = repository.get_branches()
-    matched_branches = [match for match in branches if match.name == branch_or_tag]
-    if matched_branches:
-        return matched_branches[0].commit.sha
+    matched_branch = next((b for b in branches if b.name == branch_or_tag), None)
+    if matched_branch:
+        return matched_branch.commit.sha
     tags = repository.get_tags()
-    matched_tags = [match for match in tags if match.name == branch_or_tag]
-    if not matched_tags:
+    matched_tag = next((t for t in tags if t.name == branch_or_tag), None)
+    if not matched_tag:
         raise ValueError("No Tag or Branch exists with that name")
-    return matched_tags[0].commit.sha
+    return matched_tag.commit.sha
+
+
+def list_folder_files(
+    repository: Repository,
+    sha: str,
+    path: str,
+    token: Optional[str],
+) -> Iterator[RemoteFile]:
+    """
+    Returns an iterator over all the files under path at commit sha, listed
+    with a single recursive Git Tree API call, falling back to walking the
+    contents API when the tree is truncated. Raises ValueError if path is not
+    a folder of the repository.
+    """
+    tree = repository.get_git_tree(sha, recursive=True)
+    if tree.raw_data.get("truncated"):
+        return list_folder_files_via_contents(repository, sha, path, token)
+    folder = path.strip("/")
+    if folder and not any(
+        element.type == "tree" and element.path == folder for element in tree.tree
+    ):
+        raise ValueError(f"No folder exists with the path {folder}")
+    prefix = f"{folder}/" if folder else ""
+    return (
+        RemoteFile(
+            element.path,
+            get_raw_url(repository, sha, element.path),
+            element.size,
+            element.sha,
+        )
+        for element in tree.tree
+        if element.type == "blob" and element.path.startswith(prefix)
+    )
+
+
+def list_folder_files_via_contents(
+    repository: Repository,
+    sha: str,
+    path: str,
+    token: Optional[str],
+) -> Iterator[RemoteFile]:
+    """
+    Returns an iterator over all the files under path at commit sha, walking
+    the contents API. The top-level listing is fetched right away so a missing
+    path fails before anything is downloaded.
+    """
+    contents = repository.get_dir_contents(path, ref=sha)
+    return walk_folder_contents(repository, sha, contents, token)
+
+
+def walk_folder_contents(
+    repository: Repository,
+    sha: str,
+    contents: List[ContentFile],
+    token: Optional[str],
+) -> Iterator[RemoteFile]:
+    """
+    Yields the files in contents and in all their subfolders, listing up to
+    LISTING_WORKERS subfolders concurrently. Files are yielded as soon as
+    their folder is listed, so downloads can start before the walk finishes.
+    """
+    with ThreadPoolExecutor(
+        max_workers=LISTING_WORKERS,
+        initializer=init_listing_worker,
+        initargs=(token, repository.full_name),
+    ) as executor:
+        pending: Set[Future] = set()
+        while True:
+            for content in contents:
+                if content.type == "dir":
+                    pending.add(executor.submit(list_dir_contents, content.path, sha))
+                    continue
+                if not content.download_url:
+                    print(f"Skipping {content.path}: no download URL")
+                    continue
+                yield RemoteFile(
+                    content.path,
+                    content.download_url,
+                    content.size,
+                    content.sha,
+                )
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            contents = [content for future in done for content in future.result()]
+
+
+def init_listing_worker(token: Optional[str], full_name: str) -> None:
+    """
+    Gives the current listing thread its own GitHub client, as PyGithub
+    clients keep a single connection that can't be shared between threads.
+    """
+    listing_worker.repository = Github(token).get_repo(full_name, lazy=True)
+
+
+def list_dir_contents(path: str, sha: str) -> List[ContentFile]:
+    """
+    Lists the folder at path and commit sha with the client of the current
+    listing thread.
+    """
+    return listing_worker.repository.get_dir_contents(path, ref=sha)
+
+
+def get_raw_url(repository: Repository, sha: str, path: str) -> str:
+    """
+    Returns the raw.githubusercontent.com URL of a file at commit sha.
+    """
+    return (
+        f"https://raw.githubusercontent.com/{repository.full_name}/{sha}/{quote(path)}"
+    )
+
+
+def create_session(token: Optional[str]) -> Session:
+    """
+    Returns an HTTP session with a connection pool shared by all the file
+    downloads, authenticated with the GitHub token if one is given.
+    """
+    session = Session()
+    adapter = HTTPAdapter(
+        pool_connections=DOWNLOAD_POOL_SIZE,
+        pool_maxsize=DOWNLOAD_POOL_SIZE,
+    )
+    session.mount("https://", adapter)
+    if token:
+        session.headers["Authorization"] = f"token {token}"
+    return session
+
+
+def download_file(session: Session, url: str, fullpath: str, size: int) -> None:
+    """
+    Streams the file at url to fullpath without buffering it in memory. The
+    data is written to a temporary file next to fullpath that only replaces
+    it once the whole response has been received and has the expected size.
+    """
+    folder, name = split(fullpath)
+    temppath = join(folder, f".{name}.{token_hex(8)}.part")
+    with session.get(url, stream=True, timeout=(5, 60)) as response:
+        response.raise_for_status()
+        try:
+            received = 0
+            with open(temppath, "xb") as file:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    file.write(chunk)
+                    received += len(chunk)
+            if received != size:
+                raise OSError(f"Expected {size} bytes but received {received}")
+            replace(temppath, fullpath)
+        except BaseException:
+            if exists(temppath):
+                unlink(temppath)
+            raise
+
+
+def copy_file(source: str, destination: str) -> None:
+    """
+    Copies source to destination inside the kernel with copy_file_range when
+    available, which shares extents on copy-on-write filesystems, falling back
+    to shutil.copyfile.
+    """
+    if copy_file_range is not None:
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                remaining = fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if not copied:
+                        break
+                    remaining -= copied
+            # Some filesystems report 0 bytes copied before the end of the file.
+            if not remaining:
+                return
+        except OSError:
+            pass
+    copyfile(source, destination)
 
 
 def download_folder(
@@ -80,32 +297,96 @@ def download_folder(
     path: str,
     output: Path,
     force: bool,
+    session: Session,
+    token: Optional[str],
 ) -> None:
     """
     Download all contents at server_path with commit tag sha in
     the repository.
     """
     fullpath = join(output, path)
+    if exists(fullpath) and not force:
+        print("Output folder already exists")
+        return
+    files = list_folder_files(repository, sha, path, token)
     if exists(fullpath):
-        if force:
-            rmtree(fullpath)
-        else:
-            print("Output folder already exists")
-            return
+        rmtree(fullpath)
     makedirs(fullpath)
-    contents = repository.get_dir_contents(path, ref=sha)
-    for content in contents:
-        print(f"Downloading {content.path}")
-        fullpath = join(output, content.path)
-        if content.type == "dir":
-            makedirs(fullpath)
-            download_folder(repository, sha, content.path, output, force)
-        else:
+    created_dirs = {fullpath}
+    # Paths returned by GitHub are already normalized, so appending them to
+    # the output prefix avoids normalizing the output folder once per file.
+    prefix = join(output, "")
+    # Duplicates waiting on the in-flight download of their blob, files whose
+    # own download failed and still have no content, and where each finished
+    # blob was written so later duplicates can be copied.
+    duplicates: Dict[str, List[RemoteFile]] = {}
+    failures: Dict[str, List[Tuple[RemoteFile, OSError]]] = {}
+    downloaded: Dict[str, str] = {}
+    completed: "SimpleQueue[Future]" = SimpleQueue()
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures: Dict[Future, RemoteFile] = {}
+
+        def submit(file: RemoteFile) -> None:
+            print(f"Downloading {file.path}")
+            future = executor.submit(
+                download_file,
+                session,
+                file.download_url,
+                prefix + file.path,
+                file.size,
+            )
+            futures[future] = file
+            future.add_done_callback(completed.put)
+
+        def copy(source: str, file: RemoteFile) -> None:
+            print(f"Copying {file.path}")
+            try:
+                copy_file(prefix + source, prefix + file.path)
+            except OSError as exc:
+                print(f"Error processing {file.path}: {exc}")
+
+        def finish(future: Future) -> None:
+            file = futures.pop(future)
+            try:
+                future.result()
+            except OSError as exc:
+                failures.setdefault(file.sha, []).append((file, exc))
+                # Each duplicate has its own download URL, so the next one can
+                # still be fetched and become the source for the rest, including
+                # the files that failed.
+                if duplicates[file.sha]:
+                    submit(duplicates[file.sha].pop(0))
+                else:
+                    del duplicates[file.sha]
+                return
+            downloaded[file.sha] = file.path
+            for duplicate in duplicates.pop(file.sha):
+                copy(file.path, duplicate)
+            for failed, _ in failures.pop(file.sha, []):
+                copy(file.path, failed)
+
+        for file in files:
+            parent = dirname(prefix + file.path)
             try:
-                file_content = repository.get_contents(content.path, ref=sha)
-                if not isinstance(file_content, ContentFile):
-                    raise ValueError("Expected ContentFile")
-                wget_download(file_content.download_url, fullpath)
-                print("")
-            except (GithubException, OSError, ValueError) as exc:
-                print("Error processing %s: %s", content.path, exc)
+                if parent not in created_dirs:
+                    makedirs(parent, exist_ok=True)
+                    created_dirs.add(parent)
+            except OSError as exc:
+                print(f"Error processing {file.path}: {exc}")
+                continue
+            if file.sha in downloaded:
+                copy(downloaded[file.sha], file)
+            elif file.sha in duplicates:
+                duplicates[file.sha].append(file)
+            else:
+                duplicates[file.sha] = []
+                submit(file)
+            # Handle finished downloads while listing, and wait for some when
+            # the listing runs too far ahead of the transfers.
+            while len(futures) >= DOWNLOAD_QUEUE_SIZE or not completed.empty():
+                finish(completed.get())
+        while futures:
+            finish(completed.get())
+    for group in failures.values():
+        for file, exc in group:
+            print(f"Error processing {file.path}: {exc}")